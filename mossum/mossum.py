@@ -20,9 +20,12 @@ import pydot
 import argparse
 import requests as r
 
-from bs4 import BeautifulSoup
+from html import unescape
+from requests.adapters import HTTPAdapter
 from faker import Faker
+from faker.exceptions import UniquenessException
 from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 
 parser = argparse.ArgumentParser(description=__doc__)
@@ -63,14 +66,39 @@ parser.add_argument('--min-matches', metavar='N', default=1, type=int,
 parser.add_argument('--title', dest='title', type=str, default='',
                     help='Title to be inserted in the final image')
 
+ROW_RE = re.compile(rb'<TR[^>]*>\s*<TD[^>]*>\s*<A\s[^>]*?HREF\s*=\s*["\']?([^"\'\s>]+)[^>]*>'
+                    rb'\s*([^<]*?)\s*\((\d+)%\)\s*</A>\s*(?:</TD>\s*)?'
+                    rb'<TD[^>]*>\s*<A[^>]*>\s*([^<]*?)\s*\((\d+)%\)\s*</A>\s*(?:</TD>\s*)?'
+                    rb'<TD[^>]*>\s*(\d+)', re.IGNORECASE)
+NAME_RE = re.compile(rb'<P(?:\s[^>]*)?>(.*?)(?=<(?:/?P|HR|TABLE|/BODY)\b|\Z)',
+                     re.IGNORECASE | re.DOTALL)
+TAG_RE = re.compile(rb'<[^>]*>')
+TABLE_RE = re.compile(rb'<TABLE\b', re.IGNORECASE)
+TR_RE = re.compile(rb'<TR\b', re.IGNORECASE)
+CHUNK_SIZE = 16 * 1024
+
+# Edge colors by (match percentage, --min-percent), filled in by link_color
+COLOR_CACHE = {}
+
+fake = None
+
+SESSION = r.Session()
+for prefix in ('http://', 'https://'):
+    SESSION.mount(prefix, HTTPAdapter(pool_connections=4, pool_maxsize=32))
+SESSION.headers['User-Agent'] = 'mossum'
+
 
 class Results:
+    __slots__ = ('name', 'matches')
+
     def __init__(self, name, matches):
         self.name = name
         self.matches = matches
 
 
 class Match:
+    __slots__ = ('first', 'second', 'lines', 'url')
+
     def __init__(self, first, second, lines, url):
         self.first = first
         self.second = second
@@ -83,6 +111,8 @@ class Match:
 
 
 class File:
+    __slots__ = ('name', 'percent')
+
     def __init__(self, name, percent):
         self.name = name
         self.percent = percent
@@ -98,9 +128,13 @@ class Filter:
             if getattr(args, f) != None:
                 setattr(self, f, set(getattr(args, f)))
 
-    def include(self, match):
-        first = match.first.name
-        second = match.second.name
+        self.any_filter = any(getattr(self, f) is not None for f in filters)
+        self.min_lines = args.min_lines
+        self.min_percent = args.min_percent
+
+    def include_names(self, first, second):
+        if not self.any_filter:
+            return True
         if (self.filter is not None and (first not in self.filter or second not
                                          in self.filter)):
             return False
@@ -113,47 +147,68 @@ class Filter:
         if (self.filterxi is not None and (first in self.filterxi or second in
                                            self.filterxi)):
             return False
-        return match.lines > args.min_lines and (match.first.percent > args.min_percent or
-                                                 match.second.percent > args.min_percent)
+        return True
 
 
 def date_str():
     return datetime.datetime.today().strftime('%d-%m-%Y_%H%M%S')
 
 
-def parse_col(col):
-    name, per = col.split()
-    m = re.match(args.transformer, name)
+def text(raw):
+    return unescape(raw.decode('utf-8'))
+
+
+def transform(name):
+    m = args.transformer_re.match(name)
     if m:
         if m.groups():
             name = '_'.join(m.groups())
         else:
             name = m.group()
-    per = int(re.search(r'\d+', per).group())
-    return File(name, per)
+    return name
+
+
+def get_fake():
+    # Creating a Faker loads its locale data, so share one instance
+    global fake
+    if fake is None:
+        fake = Faker()
+    return fake
 
 
 def random_names(length):
-    fake = Faker()
+    fake = get_fake()
+    fake.unique.clear()
 
-    names = set()
-    while len(names) < length:
-        names.add(fake.first_name())
+    names = []
+    try:
+        for _ in range(length):
+            names.append(fake.unique.first_name())
+    except UniquenessException:
+        # Ran out of distinct first names, number the remaining ones
+        names.extend('%s_%d' % (fake.first_name(), i) for i in range(len(names), length))
 
     return names
 
 
-def link_color(ratio):
+def link_color(percent):
+    key = (percent, args.min_percent)
+    color = COLOR_CACHE.get(key)
+    if color is not None:
+        return color
+
     high = 0xE9, 0x01, 0x01
     low = 0xFF, 0xE3, 0x05
 
     # Normalized ratio
+    ratio = percent / 100
     if args.min_percent != 100:
         min_ratio = args.min_percent / 100
         ratio = (ratio - min_ratio) / (1 - min_ratio)
 
-    color = [h * ratio + l * (1 - ratio) for h, l in zip(high, low)]
-    return '#' + ''.join(hex(int(c))[2:].zfill(2) for c in color)
+    color = '#%02x%02x%02x' % tuple(int(h * ratio + l * (1 - ratio)) for h, l in zip(high, low))
+    COLOR_CACHE[key] = color
+    return color
 
 
 def anonymize(matches):
@@ -164,9 +219,11 @@ def anonymize(matches):
 
     new_names = dict(zip(s, random_names(len(s))))
 
+    rename = new_names.__getitem__
     for m in matches:
-        m.first.name = new_names[m.first.name]
-        m.second.name = new_names[m.second.name]
+        first, second = m.first, m.second
+        first.name = rename(first.name)
+        second.name = rename(second.name)
 
 
 def generate_report(results):
@@ -181,52 +238,101 @@ def generate_report(results):
         base = '+'.join(map(lambda x: x.name, results))
     filename = '%s.txt' % base
 
-    with open(filename, 'w') as f:
-        for pair, matches in sorted(pairs.items(),
-                                    key=lambda x: (len(x[1]), sorted(map(lambda x: x[0], x[1]))), reverse=True):
-            f.write('Pair: %s and %s\n' % pair)
-            for name, match in sorted(matches):
-                f.write('%s: %s\n' % (name, match.url))
+    # Sort keys are built once per pair, -i keeps ties in insertion order
+    items = [((len(matches), tuple(sorted(name for name, _ in matches))), -i, pair, matches)
+             for i, (pair, matches) in enumerate(pairs.items())]
+    items.sort(reverse=True)
+
+    chunks = []
+    for _, _, pair, matches in items:
+        chunks.append('Pair: %s and %s\n' % pair)
+        chunks.extend('%s: %s\n' % line
+                      for line in sorted((name, match.url) for name, match in matches))
+        chunks.append('\n\n')
 
-            f.write('\n\n')
+    with open(filename, 'w') as f:
+        f.write(''.join(chunks))
 
 
 def merge_filter(matches):
-    pairs = [tuple(sorted([match.first.name, match.second.name])) for match in matches]
+    pairs = []
+    for match in matches:
+        a, b = match.first.name, match.second.name
+        pairs.append((a, b) if a <= b else (b, a))
     intereseting = {pair for pair, count in Counter(
         pairs).items() if count >= args.min_matches}
-    return [match for match in matches if tuple(sorted([match.first.name, match.second.name])) in intereseting]
+    return [match for match, pair in zip(matches, pairs) if pair in intereseting]
 
 
 def merge_results(results):
     name = '+'.join(map(lambda x: x.name, results))
-    matches = merge_filter(list(chain(*map(lambda x: x.matches, results))))
+    matches = merge_filter(list(chain.from_iterable(res.matches for res in results)))
     return Results(name, matches)
 
 
-def get_results(moss_url):
-    resp = r.get(moss_url)
-    soup = BeautifulSoup(resp.content.decode('utf-8'), 'html5lib')
+# Regroups a stream of page chunks into pieces that end on a table row
+# boundary, so that no row is split between two pieces.
+def row_segments(chunks):
+    buf = b''
+    for chunk in chunks:
+        # Only the new chunk, plus a tag that may straddle it, needs scanning
+        start = max(len(buf) - 2, 1)
+        buf += chunk
+        end = 0
+        for m in TR_RE.finditer(buf, start):
+            end = m.start()
+        if end > 0:
+            yield buf[:end]
+            buf = buf[end:]
+    yield buf
+
+
+def get_results(moss_url, index=None):
+    ps = []
+    matches = []
+    has_table = False
+    fil = Filter()
+    min_lines = fil.min_lines
+    min_percent = fil.min_percent
+
+    resp = SESSION.get(moss_url, stream=True, timeout=30)
+    try:
+        resp.raise_for_status()
+        for segment in row_segments(resp.iter_content(CHUNK_SIZE)):
+            if len(ps) <= 2:
+                ps.extend(NAME_RE.findall(segment))
+            if not has_table:
+                has_table = TABLE_RE.search(segment) is not None
+
+            for m in ROW_RE.finditer(segment):
+                url, first, first_per, second, second_per, lines = m.groups()
+                # Cheap threshold checks before building any File or Match
+                lines = int(lines)
+                if lines <= min_lines:
+                    continue
+                first_per = int(first_per)
+                second_per = int(second_per)
+                if first_per <= min_percent and second_per <= min_percent:
+                    continue
+                first = transform(text(first))
+                second = transform(text(second))
+                if not fil.include_names(first, second):
+                    continue
+                matches.append(Match(File(first, first_per), File(second, second_per),
+                                     lines, text(url)))
+    finally:
+        resp.close()
+
+    if not has_table:
+        sys.exit('No Moss results table found at %s' % moss_url)
 
-    ps = soup('p')
     name = None
-    if len(ps) >= 2:
-        name = ps[2].text.strip()
+    if len(ps) > 2:
+        name = text(TAG_RE.sub(b'', ps[2])).strip()
     if not name:
         name = 'moss_%s' % date_str()
-
-    matches = []
-
-    for row in soup.table('tr')[1:]:
-        first, second, lines = map(lambda x: x.text, row('td'))
-        first = parse_col(first)
-        second = parse_col(second)
-        lines = int(lines)
-        url = row.a['href']
-        matches.append(Match(first, second, lines, url))
-
-    fil = Filter()
-    matches = list(filter(fil.include, matches))
+        if index is not None:
+            name = '%s_%d' % (name, index)
 
     return Results(name, matches)
 
@@ -235,22 +341,30 @@ def image(results, index=None, label=None):
     graph = pydot.Dot(label=label, graph_type='graph')
 
     print('Generating image for %s' % results.name)
+    # Collapse matches between the same pair (e.g. from several merged
+    # results) into a single edge
+    edges = {}
     for m in results.matches:
-        ratio = m.percent / 100
-        color = link_color(ratio)
+        a, b = m.first.name, m.second.name
+        if a == b and not args.show_loops:
+            continue
+        edges.setdefault((a, b) if a <= b else (b, a), []).append(m)
+
+    for (a, b), ms in edges.items():
+        top = max(ms, key=lambda m: m.percent)
+        color = link_color(top.percent)
         extra_opts = {
             'color': color,
             'penwidth': 3,
         }
         if not args.hide_labels:
             extra_opts.update({
-                'label': '{0}% ({1})'.format(m.percent, m.lines),
-                'labelURL': m.url,
-                'URL': m.url,
+                'label': '+'.join('{0}% ({1})'.format(m.percent, m.lines) for m in ms),
+                'labelURL': top.url,
+                'URL': top.url,
                 'fontcolor': color,
             })
-        if m.first.name != m.second.name or args.show_loops:
-            graph.add_edge(pydot.Edge(m.first.name, m.second.name, **extra_opts))
+        graph.add_edge(pydot.Edge(a, b, **extra_opts))
 
     if args.output:
         name = args.output
@@ -272,15 +386,19 @@ def image(results, index=None, label=None):
 def main():
     global args
     args = parser.parse_args()
+    args.transformer_re = re.compile(args.transformer)
 
     urls = args.urls
     if not urls:
         urls = sys.stdin.read().splitlines()
 
-    all_res = []
-    for x in urls:
-        res = get_results(x)
-        all_res.append(res)
+    try:
+        # Number fallback names only when several pages could share one
+        indexes = range(1, len(urls) + 1) if len(urls) > 1 else [None] * len(urls)
+        with ThreadPoolExecutor(max_workers=max(1, min(32, len(urls)))) as ex:
+            all_res = list(ex.map(get_results, urls, indexes))
+    finally:
+        SESSION.close()
 
     if args.merge:
         merged = merge_results(all_res)
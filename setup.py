@@ -15,9 +15,7 @@ setup(
     description='',
     long_description='',
     install_requires=[
-        "beautifulsoup4>=4.3.2",
-        "Faker>=0.4.2",
-        "html5lib>=0.999",
+        "Faker>=4.9.0",
         "ipython>=2.3.0",
         "pydot>=1.0.29",
         "pyparsing>=2.0.2",